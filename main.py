@@ -1,19 +1,126 @@
 import base64
+import hashlib
 import os
 import re
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
 
 import streamlit as st
+import tiktoken
+from markdown_it import MarkdownIt
 from openai import OpenAI
-from openai.types.beta.assistant_stream_event import ThreadMessageDelta
-from openai.types.beta.threads.text_delta_block import TextDeltaBlock
+from openai.types.beta import Assistant
+from openai.types.beta.assistant_stream_event import AssistantStreamEvent
 
 # Retrieve API keys from Streamlit secrets
 OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 ASSISTANT_ID = st.secrets["ASSISTANT_KEY"]
 
+
+@st.cache_resource
+def get_client() -> OpenAI:
+    """
+    Create the OpenAI client shared by every rerun and session.
+
+    Returns:
+        OpenAI: The OpenAI client.
+    """
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+
+@st.cache_resource
+def get_assistant() -> Assistant:
+    """
+    Retrieve the configured assistant once per process.
+
+    Returns:
+        Assistant: The OpenAI assistant identified by ``ASSISTANT_ID``.
+    """
+    return get_client().beta.assistants.retrieve(assistant_id=ASSISTANT_ID)
+
+
+@st.cache_resource
+def get_encoding() -> tiktoken.Encoding:
+    """
+    Load the tokenizer used to measure chat messages once per process.
+
+    Returns:
+        tiktoken.Encoding: The cl100k_base encoding.
+    """
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@st.cache_resource
+def get_markdown() -> MarkdownIt:
+    """
+    Create the Markdown renderer used for the chat history once per process.
+
+    It follows the same CommonMark rules, plus tables, as st.markdown, so
+    messages look the same in the history as while they stream. Raw HTML in a
+    message is escaped rather than passed through to the page.
+
+    Returns:
+        MarkdownIt: The Markdown renderer.
+    """
+    return MarkdownIt("commonmark", {"html": False}).enable("table")
+
+
 # Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
-assistant = client.beta.assistants.retrieve(assistant_id=ASSISTANT_ID)
+client = get_client()
+assistant = get_assistant()
+threads = client.beta.threads
+thread_messages = threads.messages
+thread_runs = threads.runs
+
+# Text-to-speech voices offered in the sidebar
+VOICE_OPTIONS = ("alloy", "echo", "fable", "onyx", "nova", "shimmer")
+VOICE_HELP = (
+    "Previews can be found "
+    "[here](https://platform.openai.com/docs/guides/text-to-speech/voice-options)"
+)
+
+# Directory holding previously generated speech, keyed by voice and text. The
+# audio reads out customer data (balances, debts, credit scores), so only the
+# MAX_TTS_CACHE_FILES most recently used files are kept on disk
+TTS_CACHE_DIR = "./tts_cache"
+MAX_TTS_CACHE_FILES = 256
+# Temporary files older than this many seconds were left behind by failed writes
+STALE_TTS_PART_SECONDS = 60
+
+# Citation markers inserted by the assistant's file search, e.g. 【4:0†source】
+CITATION_RE = re.compile(r"【\d+:\d+†source】")
+
+# Only the most recent messages are kept locally; the full conversation lives
+# in the OpenAI thread
+MAX_HISTORY_MESSAGES = 200
+
+# Styling for the chat history, which is rendered as a single HTML block
+CHAT_HISTORY_CSS = """
+<style>
+.chat-message {
+    padding: 0.75rem 1rem;
+    margin-bottom: 1rem;
+    border-radius: 0.5rem;
+}
+.chat-message.user {
+    margin-left: 20%;
+    background: rgba(240, 242, 246, 0.9);
+}
+.chat-message.assistant {
+    margin-right: 20%;
+    background: rgba(255, 255, 255, 0.9);
+}
+</style>
+"""
+
+# Streamed replies are re-rendered at most every STREAM_RENDER_INTERVAL seconds,
+# or sooner once STREAM_RENDER_DELTAS deltas (about one token each) have arrived
+# since the last render
+STREAM_RENDER_INTERVAL = 0.05
+STREAM_RENDER_DELTAS = 16
 
 
 def clean_response(text: str) -> str:
@@ -26,75 +133,345 @@ def clean_response(text: str) -> str:
     Returns:
         str: Cleaned text without citation markers.
     """
-    return re.sub(r"【\d+:\d+†source】", "", text)
+    if "【" not in text:
+        return text
+    return CITATION_RE.sub("", text)
 
 
-def text_to_speech(text: str, voice: str) -> None:
+def delta_text(event: AssistantStreamEvent) -> str | None:
     """
-    Convert text to speech and display audio in the Streamlit app.
+    Extract the text carried by a streamed message delta.
+
+    Args:
+        event (AssistantStreamEvent): An event from the assistant run stream.
+
+    Returns:
+        str | None: The delta's text, or None for any other event or for
+        deltas without a text block.
+    """
+    if event.event != "thread.message.delta":
+        return None
+    content = event.data.delta.content
+    if not content or getattr(content[0], "type", None) != "text":
+        return None
+    return getattr(content[0].text, "value", None)
+
+
+def speech_cache_path(text: str, voice: str) -> str:
+    """
+    Build the on-disk cache path for a piece of synthesized speech.
+
+    Args:
+        text (str): The text converted to speech.
+        voice (str): The voice model used for text-to-speech.
+
+    Returns:
+        str: Path of the cached MP3 file.
+    """
+    key = hashlib.sha256(f"{voice}|{text}".encode()).hexdigest()
+    return os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+
+
+def prune_speech_cache() -> None:
+    """
+    Delete the least recently used speech files beyond MAX_TTS_CACHE_FILES,
+    along with temporary files left behind by failed writes.
+    """
+    stale_before = time.time() - STALE_TTS_PART_SECONDS
+    for path in Path(TTS_CACHE_DIR).glob("*.part"):
+        try:
+            if path.stat().st_mtime < stale_before:
+                path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            continue
+
+    cached_files = []
+    for path in Path(TTS_CACHE_DIR).glob("*.mp3"):
+        try:
+            cached_files.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue
+
+    cached_files.sort(reverse=True)
+    for _, path in cached_files[MAX_TTS_CACHE_FILES:]:
+        path.unlink(missing_ok=True)
+
+
+def synthesize_speech(text: str, voice: str) -> bytes:
+    """
+    Convert text to speech, reusing previously generated audio when possible.
 
     Args:
         text (str): The text to convert to speech.
         voice (str): The voice model to use for text-to-speech.
+
+    Returns:
+        bytes: MP3 audio, read from the on-disk cache or freshly generated.
     """
-    with client.audio.speech.with_streaming_response.create(
+    cache_path = speech_cache_path(text, voice)
+    try:
+        # Mark the file as recently used for prune_speech_cache
+        os.utime(cache_path)
+        return Path(cache_path).read_bytes()
+    except FileNotFoundError:
+        pass
+
+    speech = client.audio.speech.create(
         model="tts-1",
         voice=voice,
         input=text,
-    ) as response:
-        response.stream_to_file("speech.mp3")
+    ).read()
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    # A unique temporary file keeps concurrent writers of the same speech from
+    # truncating each other before it is moved into place
+    partial_file = tempfile.NamedTemporaryFile(
+        dir=TTS_CACHE_DIR, suffix=".part", delete=False
+    )
+    try:
+        with partial_file:
+            partial_file.write(speech)
+        os.replace(partial_file.name, cache_path)
+    except BaseException:
+        os.unlink(partial_file.name)
+        raise
+    prune_speech_cache()
+    return speech
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def speech_html(text: str, voice: str) -> str:
+    """
+    Build the audio player for a piece of speech.
 
-    # Convert speech to base64 encoding
-    with open("speech.mp3", "rb") as audio_file:
-        speech_base64 = base64.b64encode(audio_file.read()).decode("utf-8")
+    The finished HTML is cached, so replaying a reply skips synthesis, base64
+    encoding and formatting altogether.
+
+    Args:
+        text (str): The text to convert to speech.
+        voice (str): The voice model to use for text-to-speech.
 
-    audio_html = f"""
-    <audio id="audioTag" controls autoplay>
+    Returns:
+        str: An <audio> element embedding the base64-encoded MP3.
+    """
+    speech_base64 = base64.b64encode(synthesize_speech(text, voice)).decode("utf-8")
+    return f"""
+    <audio id="audioTag" controls autoplay preload="none">
         <source src="data:audio/mp3;base64,{speech_base64}" type="audio/mpeg">
     </audio>
     """
-    st.markdown(audio_html, unsafe_allow_html=True)
 
 
-def set_background(main_bg: str) -> None:
+@st.cache_data(max_entries=4, show_spinner=False)
+def background_css(main_bg: str, modified_at: float) -> str:
     """
-    Set background image in the Streamlit app.
+    Build the CSS that sets the background image of the Streamlit app.
 
     Args:
         main_bg (str): Path to the background image file.
+        modified_at (float): Modification time of the file, so edits to the
+            image invalidate the cached CSS.
+
+    Returns:
+        str: A <style> block embedding the base64-encoded image.
     """
     main_bg_ext = os.path.splitext(main_bg)[-1].lstrip(".")
-    with open(main_bg, "rb") as image_file:
-        encoded_bg = base64.b64encode(image_file.read()).decode()
+    encoded_bg = base64.b64encode(Path(main_bg).read_bytes()).decode()
 
-    st.markdown(
-        f"""
+    return f"""
         <style>
         .stApp {{
             background: url(data:image/{main_bg_ext};base64,{encoded_bg});
             background-size: cover;
         }}
         </style>
-        """,
+        """
+
+
+def set_background(main_bg: str) -> None:
+    """
+    Set background image in the Streamlit app.
+
+    Args:
+        main_bg (str): Path to the background image file.
+    """
+    st.markdown(
+        background_css(main_bg, os.path.getmtime(main_bg)),
         unsafe_allow_html=True,
     )
 
 
+@st.cache_data(max_entries=1024, show_spinner=False)
+def markdown_html(text: str) -> str:
+    """
+    Convert a chat message from Markdown to HTML.
+
+    Args:
+        text (str): The message text in Markdown.
+
+    Returns:
+        str: The rendered HTML.
+    """
+    return get_markdown().render(text)
+
+
+def history_html() -> str:
+    """
+    Render the chat history as a single HTML string.
+
+    The result is memoized in the session state and only rebuilt after a new
+    message has been added.
+
+    Returns:
+        str: One role-styled <div> per message in the chat history.
+    """
+    version = st.session_state["history_version"]
+    rendered = st.session_state.get("history_html")
+    if rendered is None or rendered[0] != version:
+        rendered = (
+            version,
+            "".join(
+                f'<div class="chat-message {message["role"]}">'
+                f'{markdown_html(message["content"])}</div>'
+                for message in st.session_state["chat_history"]
+            ),
+        )
+        st.session_state["history_html"] = rendered
+    return rendered[1]
+
+
+def history_token_count() -> int:
+    """
+    Count the tokens in the locally kept chat history.
+
+    The count is memoized in the session state and only recomputed after a new
+    message has been added.
+
+    Returns:
+        int: The total number of tokens across the stored messages.
+    """
+    version = st.session_state["history_version"]
+    counted = st.session_state.get("history_tokens")
+    if counted is None or counted[0] != version:
+        history_tokens = get_encoding().encode_ordinary_batch(
+            [message["content"] for message in st.session_state["chat_history"]]
+        )
+        counted = (version, sum(map(len, history_tokens)))
+        st.session_state["history_tokens"] = counted
+    return counted[1]
+
+
+def add_to_history(role: str, content: str) -> None:
+    """
+    Record a finished chat message in the session history.
+
+    Args:
+        role (str): The message author, either "user" or "assistant".
+        content (str): The message text.
+    """
+    st.session_state["chat_history"].append({"role": role, "content": content})
+    st.session_state["history_version"] += 1
+
+
+def reply_to_user(user_query: str, speech_on: bool, voice: str) -> None:
+    """
+    Send the user's message to the assistant and stream its reply.
+
+    Args:
+        user_query (str): The message entered by the user.
+        speech_on (bool): Whether to read the reply out loud.
+        voice (str): The voice model to use for text-to-speech.
+    """
+    thread_messages.create(
+        thread_id=st.session_state["thread_id"],
+        role="user",
+        content=user_query,
+    )
+
+    # Speech runs on a worker owned by this reply, so concurrent sessions never
+    # queue behind each other's text-to-speech requests
+    speech_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts")
+    try:
+        with st.chat_message("assistant"):
+            assistant_reply_box = st.empty()
+            reply_chunks: list[str] = []
+            pending_deltas = 0
+            last_render = time.monotonic()
+            speech_future: Future[str] | None = None
+            speech_text = ""
+
+            # Closing the stream returns its connection to the shared client's
+            # pool even if the rerun is interrupted mid-reply
+            with thread_runs.create(
+                thread_id=st.session_state["thread_id"],
+                assistant_id=ASSISTANT_ID,
+                stream=True,
+            ) as stream:
+                for event in stream:
+                    # The reply text is final once its message completes, so start
+                    # generating speech while the remaining run events arrive
+                    if event.event == "thread.message.completed":
+                        if speech_on and speech_future is None and reply_chunks:
+                            speech_text = "".join(reply_chunks)
+                            speech_future = speech_executor.submit(
+                                speech_html, speech_text, voice
+                            )
+                        continue
+
+                    text = delta_text(event)
+                    if text is None:
+                        continue
+
+                    # A later message makes the started speech stale; drop it if
+                    # it has not begun yet
+                    if speech_future is not None:
+                        speech_future.cancel()
+
+                    text = clean_response(text)
+                    reply_chunks.append(text)
+                    pending_deltas += 1
+                    now = time.monotonic()
+                    if (
+                        now - last_render >= STREAM_RENDER_INTERVAL
+                        or pending_deltas >= STREAM_RENDER_DELTAS
+                    ):
+                        assistant_reply_box.markdown("".join(reply_chunks))
+                        pending_deltas = 0
+                        last_render = now
+
+            assistant_reply = "".join(reply_chunks)
+            assistant_reply_box.markdown(assistant_reply)
+
+            if speech_on and assistant_reply:
+                with st.spinner("Generating your audio - this can take a while"):
+                    # Text added after the message completed needs fresh speech
+                    if speech_future is not None and speech_text == assistant_reply:
+                        audio_html = speech_future.result()
+                    else:
+                        audio_html = speech_html(assistant_reply, voice)
+                st.markdown(audio_html, unsafe_allow_html=True)
+
+            add_to_history("assistant", assistant_reply)
+    finally:
+        speech_executor.shutdown(wait=False, cancel_futures=True)
+
+
 # Configure the Streamlit app
 st.set_page_config(page_title="Banking Chatbot", page_icon="💬", layout="centered")
 set_background("./assets/bg_reduced.png")
 
 # Initialize chat history in session state
 if "chat_history" not in st.session_state:
-    st.session_state["chat_history"] = [
-        {
-            "role": "assistant",
-            "content": "Hello, how can I help you today with your financial needs?",
-        }
-    ]
+    st.session_state["chat_history"] = deque(maxlen=MAX_HISTORY_MESSAGES)
+    st.session_state["history_version"] = 0
+    add_to_history(
+        "assistant", "Hello, how can I help you today with your financial needs?"
+    )
 
 # App title and description
 st.title("🏦 Banking Chatbot")
+# Refreshed below once this turn's messages have been added to the history
+token_caption = st.empty()
+token_caption.caption(f"Recent messages: {history_token_count()} tokens")
 with st.expander("What is this app about?"):
     st.warning(
         """
@@ -123,60 +500,24 @@ with st.expander("What is this app about?"):
 with st.sidebar:
     voice_bot = st.selectbox(
         "Select chatbot voice",
-        ["alloy", "echo", "fable", "onyx", "nova", "shimmer"],
-        help=(
-            "Previews can be found "
-            "[here](https://platform.openai.com/docs/guides/text-to-speech/voice-options)"
-        ),
+        VOICE_OPTIONS,
+        help=VOICE_HELP,
     )
     speech_on = st.checkbox("Enable speech output?")
 
 # Display chat history
-for message in st.session_state["chat_history"]:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+st.html(CHAT_HISTORY_CSS + history_html())
 
 # Handle user input
 user_query = st.chat_input("Input a prompt...")
 if user_query:
     if "thread_id" not in st.session_state:
-        thread = client.beta.threads.create()
+        thread = threads.create()
         st.session_state["thread_id"] = thread.id
 
     with st.chat_message("user"):
         st.markdown(user_query)
-    st.session_state["chat_history"].append({"role": "user", "content": user_query})
+    add_to_history("user", user_query)
 
-    client.beta.threads.messages.create(
-        thread_id=st.session_state["thread_id"],
-        role="user",
-        content=user_query,
-    )
-
-    with st.chat_message("assistant"):
-        stream = client.beta.threads.runs.create(
-            thread_id=st.session_state["thread_id"],
-            assistant_id=ASSISTANT_ID,
-            stream=True,
-        )
-
-        assistant_reply_box = st.empty()
-        assistant_reply = ""
-
-        for event in stream:
-            if isinstance(event, ThreadMessageDelta):
-                if event.data.delta.content and isinstance(
-                    event.data.delta.content[0], TextDeltaBlock
-                ):
-                    assistant_reply += clean_response(
-                        event.data.delta.content[0].text.value
-                    )
-                    assistant_reply_box.markdown(assistant_reply)
-
-        if speech_on:
-            with st.spinner("Generating your audio - this can take a while"):
-                text_to_speech(assistant_reply, voice_bot)
-
-        st.session_state["chat_history"].append(
-            {"role": "assistant", "content": assistant_reply}
-        )
+    reply_to_user(user_query, speech_on, voice_bot)
+    token_caption.caption(f"Recent messages: {history_token_count()} tokens")